@@ -2,20 +2,23 @@
 
 from tornado import web
 import os
+import atexit
+import threading
 
 from io import StringIO
 import datetime
 
 import pymongo
+from pymongo.errors import BulkWriteError, ConnectionFailure, DocumentTooLarge, InvalidDocument
 
 try:
-    from mongodb_proxy import MongoProxy
+    from mongodb_proxy import MongoProxy, safe_mongocall
 except:
-    from .mongodb_proxy import MongoProxy
+    from .mongodb_proxy import MongoProxy, safe_mongocall
 
 from IPython.html.services.notebooks.nbmanager import NotebookManager
 from IPython.nbformat import current
-from IPython.utils.traitlets import Unicode, CBool
+from IPython.utils.traitlets import Unicode, CBool, Float, Integer
 
 
 def sort_key(item):
@@ -55,6 +58,14 @@ class MongoNotebookManager(NotebookManager):
         help="Save all checkpoints or keep only last"
     )
 
+    autosave_coalesce_window = Float(0, config=True,
+        help="Seconds during which repeated saves of a notebook are buffered and only the latest is written. 0 disables buffering"
+    )
+
+    autosave_buffer_size = Integer(16 * 1024 * 1024, config=True,
+        help="Flush buffered saves once their total UTF-8 encoded content exceeds this many bytes"
+    )
+
     def __init__(self, **kwargs):
         super(MongoNotebookManager, self).__init__(**kwargs)
         if len(self.replica_set) == 0:
@@ -62,14 +73,24 @@ class MongoNotebookManager(NotebookManager):
         else:
             self._conn = self._connect_replica_set()
 
+        self._pending_autosaves = {}
+        self._pending_autosave_bytes = 0
+        self._autosave_timer = None
+        self._autosave_lock = threading.RLock()
+        if self.autosave_coalesce_window > 0:
+            atexit.register(self.flush_autosaves)
+
     def get_notebook_names(self, path=''):
         """List all notebook names in the notebook dir and path."""
         path = path.strip('/')
+        with self._autosave_lock:
+            pending = [key[1] for key in self._pending_autosaves if key[0] == path]
         spec = {'path': path,
                 'type': 'notebook'}
         fields = {'name': 1}
         notebooks = list(self._connect_collection(self.notebook_collection).find(spec,fields))
         names = [n['name'] for n in notebooks]
+        names.extend(name for name in pending if name not in names)
         return names
 
     def path_exists(self, path):
@@ -88,6 +109,9 @@ class MongoNotebookManager(NotebookManager):
         """
 
         path = path.strip('/')
+        with self._autosave_lock:
+            if any(key[0] == path for key in self._pending_autosaves):
+                return True
         if path != '':
             spec = {'path': path}
             count = self._connect_collection(self.notebook_collection).find(spec).count()
@@ -101,6 +125,9 @@ class MongoNotebookManager(NotebookManager):
 
     def notebook_exists(self, name, path=''):
         path = path.strip('/')
+        with self._autosave_lock:
+            if (path, name) in self._pending_autosaves:
+                return True
         spec = {
             'path': path,
             'name': name,
@@ -166,6 +193,12 @@ class MongoNotebookManager(NotebookManager):
 
     def get_notebook(self, name, path='', content=True):
         path = path.strip('/')
+        if content:
+            self._flush_autosaves([(path, name)])
+        else:
+            model = self._pending_autosave_model(name, path)
+            if model is not None:
+                return model
         if not self.notebook_exists(name=name, path=path):
             raise web.HTTPError(404, u'Notebook does not exist: %s' % name)
 
@@ -213,6 +246,7 @@ class MongoNotebookManager(NotebookManager):
         model['path'] = path
         model['type'] = 'notebook'
         model = self.save_notebook(model, model['name'], model['path'])
+        self._flush_autosaves([(model['path'], model['name'])])
 
         return model
 
@@ -222,8 +256,11 @@ class MongoNotebookManager(NotebookManager):
         if 'content' not in model:
             raise web.HTTPError(400, u'No notebook JSON data provided')
 
-        # One checkpoint should always exist
-        if self.notebook_exists(name, path) and not self.list_checkpoints(name, path):
+        # One checkpoint should always exist. A buffered save means this
+        # was already checked earlier in the coalescing window.
+        with self._autosave_lock:
+            pending = (path, name) in self._pending_autosaves
+        if not pending and self.notebook_exists(name, path) and not self.list_checkpoints(name, path):
             self.create_checkpoint(name, path)
 
         new_path = model.get('path', path).strip('/')
@@ -258,9 +295,18 @@ class MongoNotebookManager(NotebookManager):
                     data['$set']['created'] = model['created']
                 else:
                     data['$set']['created'] = datetime.datetime.now()
-                notebook = self._connect_collection(self.notebook_collection).update(spec,data, upsert=True)
+                if self.autosave_coalesce_window > 0:
+                    self._queue_autosave(spec, data)
+                else:
+                    notebook = self._connect_collection(self.notebook_collection).update(spec,data, upsert=True)
         except Exception as e:
             raise web.HTTPError(400, u'Unexpected error while autosaving notebook: %s' % (e))
+
+        if self.autosave_coalesce_window > 0:
+            # Build the model from the buffered write instead of reading it
+            # back from mongodb, where it may not have landed yet.
+            return self._autosave_model(new_name, new_path, data)
+
         model = self.get_notebook(new_name, new_path, content=False)
 
         return model
@@ -276,6 +322,8 @@ class MongoNotebookManager(NotebookManager):
 
     def delete_notebook(self, name, path=''):
         path = path.strip('/')
+        # No need to write a buffered save that is about to be deleted
+        buffered = self._discard_autosave(name, path)
         spec = {
             'path': path,
             'name': name
@@ -285,7 +333,7 @@ class MongoNotebookManager(NotebookManager):
         }
 
         notebook = self._connect_collection(self.notebook_collection).find_one(spec,fields)
-        if not notebook:
+        if not notebook and not buffered:
             raise web.HTTPError(404, u'Notebook does not exist: %s' % name)
 
         # clear checkpoints
@@ -297,6 +345,7 @@ class MongoNotebookManager(NotebookManager):
         new_path = new_path.strip('/')
         if new_name == old_name and new_path == old_path:
             return
+        self._flush_autosaves([(old_path, old_name), (new_path, new_name)])
 
         # Should we proceed with the move?
         spec = {
@@ -342,6 +391,8 @@ class MongoNotebookManager(NotebookManager):
     # public checkpoint API
     def create_checkpoint(self, name, path=''):
         path = path.strip('/')
+        # An explicit save is always followed by a checkpoint
+        self._flush_autosaves([(path, name)])
         spec = {
             'path': path,
             'name': name
@@ -389,6 +440,8 @@ class MongoNotebookManager(NotebookManager):
             raise web.HTTPError(
                 404, u'Notebook checkpoint does not exist: %s-%s' % (name, checkpoint_id)
             )
+        # The checkpoint replaces any buffered save
+        self._discard_autosave(name, path)
         del spec['cp']
         del checkpoint['cp']
         del checkpoint['_id']
@@ -415,6 +468,140 @@ class MongoNotebookManager(NotebookManager):
     def get_kernel_path(self, name, path='', model=None):
         return os.path.join(self.notebook_dir, path)
 
+    # write-behind autosave buffer
+    def flush_autosaves(self):
+        """Write all buffered saves to mongodb in a single bulk operation."""
+        self._flush_autosaves()
+
+    def _autosave_model(self, name, path, data):
+        model = {}
+        model['name'] = name
+        model['path'] = path
+        model['last_modified'] = data['$set']['lastModified']
+        model['created'] = data['$set']['created']
+        model['type'] = 'notebook'
+        return model
+
+    def _pending_autosave_model(self, name, path):
+        """Return the model of a buffered save without content, or None."""
+        with self._autosave_lock:
+            entry = self._pending_autosaves.get((path, name))
+            if entry is None:
+                return None
+            return self._autosave_model(name, path, entry[1])
+
+    def _queue_autosave(self, spec, data):
+        key = (spec['path'], spec['name'])
+        size = len(data['$set']['content'].encode('utf-8'))
+        with self._autosave_lock:
+            previous = self._pending_autosaves.get(key)
+            if previous is not None:
+                self._pending_autosave_bytes -= previous[2]
+            self._pending_autosaves[key] = (spec, data, size)
+            self._pending_autosave_bytes += size
+            if self._pending_autosave_bytes <= self.autosave_buffer_size:
+                self._schedule_autosave_flush()
+                return
+        self._flush_autosaves()
+
+    def _discard_autosave(self, name, path):
+        """Drop the buffered save of a notebook. Returns whether there was one."""
+        with self._autosave_lock:
+            entry = self._pending_autosaves.pop((path, name), None)
+            if entry is None:
+                return False
+            self._pending_autosave_bytes -= entry[2]
+            if not self._pending_autosaves and self._autosave_timer is not None:
+                self._autosave_timer.cancel()
+                self._autosave_timer = None
+            return True
+
+    def _schedule_autosave_flush(self):
+        with self._autosave_lock:
+            if self._autosave_timer is None:
+                self._autosave_timer = threading.Timer(
+                    self.autosave_coalesce_window, self._flush_autosaves_on_timer
+                )
+                self._autosave_timer.daemon = True
+                self._autosave_timer.start()
+
+    def _flush_autosaves_on_timer(self):
+        with self._autosave_lock:
+            if self._autosave_timer is not threading.current_thread():
+                # The buffer was flushed while this timer waited for the
+                # lock, and a newer timer covers any saves queued since.
+                return
+            self._autosave_timer = None
+            self._flush_autosaves()
+
+    def _flush_autosaves(self, keys=None):
+        """Write the buffered saves for keys, or all of them if keys is None.
+
+        The lock is held until the write completes so that readers never see
+        mongodb lagging behind a save that has left the buffer. Saves that
+        failed are put back in the buffer, except those mongodb can never
+        accept, which are dropped. Errors are only raised when flushing
+        specific keys, as the caller depends on those saves having landed.
+        """
+        with self._autosave_lock:
+            keys_given = keys is not None
+            if not keys_given:
+                keys = list(self._pending_autosaves)
+            entries = [self._pending_autosaves.pop(key) for key in keys
+                       if key in self._pending_autosaves]
+            if not entries:
+                return
+            self._pending_autosave_bytes -= sum(entry[2] for entry in entries)
+            if not self._pending_autosaves and self._autosave_timer is not None:
+                self._autosave_timer.cancel()
+                self._autosave_timer = None
+
+            # A bulk operation can only be executed once, so it is rebuilt
+            # on every AutoReconnect retry.
+            @safe_mongocall
+            def write():
+                bulk = self._connect_collection(self.notebook_collection).initialize_unordered_bulk_op()
+                for spec, data, size in entries:
+                    bulk.find(spec).upsert().update_one(data)
+                return bulk.execute()
+
+            retry = []
+            dropped = []
+            try:
+                write()
+            except BulkWriteError as e:
+                # The other writes in the batch went through
+                retry = [(entries[error['index']], error['errmsg'])
+                         for error in e.details['writeErrors']]
+            except ConnectionFailure as e:
+                retry = [(entry, e) for entry in entries]
+            except Exception:
+                # Write the saves one by one so that a single bad notebook
+                # does not hold back the others
+                for entry in entries:
+                    try:
+                        self._connect_collection(self.notebook_collection).update(entry[0], entry[1], upsert=True)
+                    except (DocumentTooLarge, InvalidDocument) as e:
+                        dropped.append((entry, e))
+                    except Exception as e:
+                        retry.append((entry, e))
+
+            for entry, error in retry:
+                key = (entry[0]['path'], entry[0]['name'])
+                self._pending_autosaves[key] = entry
+                self._pending_autosave_bytes += entry[2]
+                self.log.error(u'Error while saving notebook %s/%s, will retry: %s',
+                               key[0], key[1], error)
+            for entry, error in dropped:
+                self.log.error(u'Discarding notebook save that cannot be stored %s/%s: %s',
+                               entry[0]['path'], entry[0]['name'], error)
+            if retry:
+                self._schedule_autosave_flush()
+
+            failed = retry + dropped
+            if failed and keys_given:
+                raise web.HTTPError(500, u'Unexpected error while saving notebook: %s' % (failed[0][1]))
+
     #mongodb related functions
     def _connect_server(self):
         return MongoProxy(pymongo.MongoClient(self.mongo_uri))
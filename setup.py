@@ -29,7 +29,7 @@ setup(
         'Operating System :: OS Independent'
     ],
     install_requires=[
-        'pymongo',
+        'pymongo>=2.7,<3',
         'ipython<3'
     ],
     entry_points={